@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 import argparse
-import glob
+import hashlib
 import lzma
 import multiprocessing
 import os
 import platform
+import re
 import shutil
+import signal
 import stat
+import struct
 import subprocess
 import sys
 import tarfile
+import tempfile
 import textwrap
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from zipfile import ZipFile
 
@@ -58,12 +63,21 @@ if not sys.version_info >= (3, 8):
 if "ANDROID_SDK_ROOT" not in os.environ:
     error("Please set Android SDK path to environment variable ANDROID_SDK_ROOT!")
 
-if shutil.which("sccache") is not None:
+# ccache is faster than sccache for C/C++, but only sccache can cache Rust.
+# Export the bare command names, ndk-build does not quote NDK_CCACHE.
+has_sccache = shutil.which("sccache") is not None
+has_ccache = shutil.which("ccache") is not None
+if has_ccache or has_sccache:
+    os.environ["NDK_CCACHE"] = "ccache" if has_ccache else "sccache"
+if has_sccache:
     os.environ["RUSTC_WRAPPER"] = "sccache"
-    os.environ["NDK_CCACHE"] = "sccache"
     os.environ["CARGO_INCREMENTAL"] = "0"
-if shutil.which("ccache") is not None:
-    os.environ["NDK_CCACHE"] = "ccache"
+if has_ccache:
+    # Keep cache keys stable across source tree relocations
+    os.environ.setdefault("CCACHE_BASEDIR", os.getcwd())
+    os.environ.setdefault(
+        "CCACHE_SLOPPINESS", "time_macros,include_file_mtime,file_macro"
+    )
 
 cpu_count = multiprocessing.cpu_count()
 os_name = platform.system().lower()
@@ -75,6 +89,10 @@ triples = [
     "aarch64-linux-android",
     "x86_64-linux-android",
 ]
+rust_triples = [
+    "thumbv7neon-linux-androideabi" if triple.startswith("armv7") else triple
+    for triple in triples
+]
 default_targets = ["magisk", "magiskinit", "magiskboot", "magiskpolicy", "busybox"]
 support_targets = default_targets + ["resetprop"]
 rust_targets = ["magisk", "magiskinit", "magiskboot", "magiskpolicy"]
@@ -82,13 +100,16 @@ rust_targets = ["magisk", "magiskinit", "magiskboot", "magiskpolicy"]
 sdk_path = Path(os.environ["ANDROID_SDK_ROOT"])
 ndk_root = sdk_path / "ndk"
 ndk_path = ndk_root / "magisk"
-ndk_build = ndk_path / "ndk-build"
+ndk_build = ndk_path / ("ndk-build.cmd" if is_windows else "ndk-build")
 rust_bin = ndk_path / "toolchains" / "rust" / "bin"
 llvm_bin = ndk_path / "toolchains" / "llvm" / "prebuilt" / f"{os_name}-x86_64" / "bin"
 cargo = rust_bin / f"cargo{EXE_EXT}"
 gradlew = Path("gradlew" + (".bat" if is_windows else "")).resolve()
 adb_path = sdk_path / "platform-tools" / f"adb{EXE_EXT}"
+native_src = Path("native", "src")
+native_src_root = Path("..", "..")
 native_gen_path = Path("native", "out", "generated").resolve()
+xz_cache_path = Path("native", "out", ".xz_cache").resolve()
 
 # Global vars
 config = {}
@@ -139,36 +160,29 @@ def execv(cmd, env=None):
     return subprocess.run(cmd, stdout=STDOUT, env=env)
 
 
-def system(cmd):
-    return subprocess.run(cmd, shell=True, stdout=STDOUT)
-
-
 def cmd_out(cmd, env=None):
-    return (
-        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
-        .stdout.strip()
-        .decode("utf-8")
-    )
+    return subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        encoding="utf-8",
+    ).stdout.strip()
 
 
 def xz(data):
     return lzma.compress(data, preset=9, check=lzma.CHECK_NONE)
 
 
+# key=value lines, skipping comments, empty values and values containing "="
+prop_re = re.compile(
+    r"^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*([^=\n]*[^=\s])[ \t\r]*$", re.M
+)
+
+
 def parse_props(file):
-    props = {}
     with open(file, "r") as f:
-        for line in [l.strip(" \t\r\n") for l in f]:
-            if line.startswith("#") or len(line) == 0:
-                continue
-            prop = line.split("=")
-            if len(prop) != 2:
-                continue
-            value = prop[1].strip(" \t\r\n")
-            if len(value) == 0:
-                continue
-            props[prop[0].strip(" \t\r\n")] = value
-    return props
+        return dict(prop_re.findall(f.read()))
 
 
 def load_config(args):
@@ -195,6 +209,9 @@ def load_config(args):
     except ValueError:
         error('Config error: "versionCode" is required to be an integer')
 
+    if args.jobs < 1:
+        error('"--jobs" is required to be a positive integer')
+
     config["outdir"] = Path(config["outdir"])
 
     config["outdir"].mkdir(mode=0o755, parents=True, exist_ok=True)
@@ -229,29 +246,71 @@ def clean_elf():
     execv(args)
 
 
-def run_ndk_build(flags):
-    os.chdir("native")
-    flags = "NDK_PROJECT_PATH=. NDK_APPLICATION_MK=src/Application.mk " + flags
-    proc = system(f"{ndk_build} {flags} -j{cpu_count}")
-    if proc.returncode != 0:
+def start_ndk_build(flags, jobs=None, background=False):
+    cmds = [ndk_build, "NDK_PROJECT_PATH=.", "NDK_APPLICATION_MK=src/Application.mk"]
+    kwargs = {}
+    if background:
+        # Run in its own process group so make and the compilers
+        # can be stopped together with the ndk-build wrapper
+        if is_windows:
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+    return subprocess.Popen(
+        [*cmds, *flags, f"-j{jobs or args.jobs}"],
+        cwd="native",
+        stdout=STDOUT,
+        **kwargs,
+    )
+
+
+def kill_ndk_build(proc):
+    if is_windows:
+        subprocess.run(
+            ["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    proc.wait()
+
+
+def wait_ndk_build(proc):
+    if proc.wait() != 0:
         error("Build binary failed!")
-    os.chdir("..")
     for arch in archs:
+        arch_out = Path("native", "out", arch)
+        arch_out.mkdir(mode=0o755, parents=True, exist_ok=True)
         for tgt in support_targets + ["libinit-ld.so"]:
+            # Most targets are not built in every ndk-build run
             source = Path("native", "libs", arch, tgt)
-            target = Path("native", "out", arch, tgt)
-            mv(source, target)
+            if source.exists():
+                target = arch_out / tgt
+                os.replace(source, target)
+                vprint(f"mv {source} -> {target}")
+
+
+def run_ndk_build(flags):
+    wait_ndk_build(start_ndk_build(flags))
 
 
-def run_cargo(cmds, triple="aarch64-linux-android"):
+def cargo_env(jobs):
     env = os.environ.copy()
     env["PATH"] = f'{rust_bin}{os.pathsep}{env["PATH"]}'
     env["CARGO_BUILD_RUSTC"] = str(rust_bin / f"rustc{EXE_EXT}")
-    env["RUSTFLAGS"] = f"-Clinker-plugin-lto -Zthreads={min(8, cpu_count)}"
+    env["RUSTFLAGS"] = f"-Clinker-plugin-lto -Zthreads={min(8, jobs)}"
+    return env
+
+
+def run_cargo(cmds, env):
     return execv([cargo, *cmds], env)
 
 
-def run_cargo_build(args):
+def run_cargo_build(args, jobs):
     native_out = Path("..", "out")
     native_out.mkdir(mode=0o755, exist_ok=True)
 
@@ -270,19 +329,18 @@ def run_cargo_build(args):
         rust_out = "release"
     if not args.verbose:
         cmds.append("-q")
+    cmds.append(f"-j{jobs}")
 
     cmds.append("--target")
     cmds.append("")
 
-    for arch, triple in zip(archs, triples):
-        rust_triple = (
-            "thumbv7neon-linux-androideabi" if triple.startswith("armv7") else triple
-        )
+    env = cargo_env(jobs)
+    for arch, rust_triple in zip(archs, rust_triples):
         cmds[-1] = rust_triple
 
         for target in targets:
             cmds[2] = target
-            proc = run_cargo(cmds, triple)
+            proc = run_cargo(cmds, env)
             if proc.returncode != 0:
                 error("Build binary failed!")
 
@@ -299,12 +357,20 @@ def run_cargo_cmd(args):
     STDOUT = None
     if len(args.commands) >= 1 and args.commands[0] == "--":
         args.commands = args.commands[1:]
-    os.chdir(Path("native", "src"))
-    run_cargo(args.commands)
-    os.chdir(Path("..", ".."))
+    os.chdir(native_src)
+    run_cargo(args.commands, cargo_env(args.jobs))
+    os.chdir(native_src_root)
 
 
 def write_if_diff(file_name: Path, text: str):
+    # The stamp stores the hash of the last written content
+    stamp = file_name.with_suffix(file_name.suffix + ".sha")
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    if file_name.exists() and stamp.exists():
+        with open(stamp, "r") as f:
+            if f.read() == digest:
+                return
+
     do_write = True
     if file_name.exists():
         with open(file_name, "r") as f:
@@ -313,25 +379,57 @@ def write_if_diff(file_name: Path, text: str):
     if do_write:
         with open(file_name, "w") as f:
             f.write(text)
-
-
-def binary_dump(src, var_name, compressor=xz):
-    out_str = f"constexpr unsigned char {var_name}[] = {{"
-    for i, c in enumerate(compressor(src.read())):
-        if i % 16 == 0:
-            out_str += "\n"
-        out_str += f"0x{c:02X},"
+    with open(stamp, "w") as f:
+        f.write(digest)
+
+
+def binary_dump(src, var_name, compressor=xz, cache_name=None):
+    data = src.read()
+    # Compression is expensive, cache the output along with the input hash
+    stamp = f"{compressor.__name__} u64 {hashlib.sha256(data).hexdigest()}\n"
+    if cache_name:
+        cache = xz_cache_path / f"{cache_name}.txt"
+        if cache.exists():
+            with open(cache, "r") as f:
+                if f.readline() == stamp:
+                    return f.read()
+
+    # Pack into little endian 64-bit words to reduce the tokens the compiler
+    # has to parse. All supported ABIs are little endian.
+    data = compressor(data)
+    size = len(data)
+    data += bytes(-size % 8)
+    words = [f"0x{w:016X}," for (w,) in struct.iter_unpack("<Q", data)]
+    rows = ("".join(words[i : i + 4]) for i in range(0, len(words), 4))
+    out_str = f"constexpr uint64_t {var_name}[] = {{\n"
+    out_str += "\n".join(rows)
     out_str += "\n};\n"
+    out_str += f"constexpr size_t {var_name}_size = {size};\n"
+
+    if cache_name:
+        # Replace the previous entry so the cache does not grow
+        xz_cache_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=xz_cache_path, suffix=".tmp", delete=False
+        ) as f:
+            f.write(stamp)
+            f.write(out_str)
+        os.replace(f.name, cache)
     return out_str
 
 
+def dump_arch_bin(arch):
+    preload = Path("native", "out", arch, "libinit-ld.so")
+    with open(preload, "rb") as src:
+        return binary_dump(src, "init_ld_xz", cache_name=f"{arch}_init_ld_xz")
+
+
 def dump_bin_header(args):
     native_gen_path.mkdir(mode=0o755, parents=True, exist_ok=True)
-    for arch in archs:
-        preload = Path("native", "out", arch, "libinit-ld.so")
-        with open(preload, "rb") as src:
-            text = binary_dump(src, "init_ld_xz")
-        write_if_diff(Path(native_gen_path, f"{arch}_binaries.h"), text)
+    # lzma releases the GIL while compressing
+    with ThreadPoolExecutor(max_workers=min(len(archs), args.jobs)) as executor:
+        for arch, text in zip(archs, executor.map(dump_arch_bin, archs)):
+            write_if_diff(Path(native_gen_path, f"{arch}_binaries.h"), text)
 
 
 def dump_flag_header():
@@ -372,54 +470,70 @@ def build_binary(args):
 
     header("* Building binaries: " + " ".join(args.target))
 
-    os.chdir(Path("native", "src"))
-    run_cargo_build(args)
-    os.chdir(Path("..", ".."))
-
-    dump_flag_header()
+    # BusyBox is built with different API level and does not depend
+    # on any Rust code, so build it alongside cargo with half of the jobs
+    bb_proc = None
+    cargo_jobs = args.jobs
+    if "busybox" in args.target and args.jobs > 1:
+        bb_jobs = args.jobs // 2
+        cargo_jobs = args.jobs - bb_jobs
+        bb_proc = start_ndk_build(["B_BB=1"], bb_jobs, background=True)
 
-    flag = ""
+    try:
+        os.chdir(native_src)
+        run_cargo_build(args, cargo_jobs)
+        os.chdir(native_src_root)
+
+        dump_flag_header()
+    except BaseException:
+        # Do not leave ndk-build running in the background on failure
+        if bb_proc:
+            kill_ndk_build(bb_proc)
+        raise
+
+    # Never run multiple ndk-build instances on the same output folder
+    if bb_proc:
+        wait_ndk_build(bb_proc)
+    elif "busybox" in args.target:
+        run_ndk_build(["B_BB=1"])
+
+    flags = []
     clean = False
 
     if "magisk" in args.target:
-        flag += " B_MAGISK=1"
+        flags.append("B_MAGISK=1")
         clean = True
 
     if "magiskpolicy" in args.target:
-        flag += " B_POLICY=1"
+        flags.append("B_POLICY=1")
         clean = True
 
     if "magiskinit" in args.target:
-        flag += " B_PRELOAD=1"
+        flags.append("B_PRELOAD=1")
 
     if "resetprop" in args.target:
-        flag += " B_PROP=1"
+        flags.append("B_PROP=1")
 
-    if flag:
-        run_ndk_build(flag)
+    if flags:
+        run_ndk_build(flags)
 
-    flag = ""
+    flags = []
 
     if "magiskinit" in args.target:
         # magiskinit embeds preload.so
         dump_bin_header(args)
-        flag += " B_INIT=1"
+        flags.append("B_INIT=1")
 
     if "magiskboot" in args.target:
-        flag += " B_BOOT=1"
+        flags.append("B_BOOT=1")
 
-    if flag:
-        flag += " B_CRT0=1"
-        run_ndk_build(flag)
+    if flags:
+        flags.append("B_CRT0=1")
+        run_ndk_build(flags)
 
     if clean:
         clean_elf()
 
-    # BusyBox is built with different API level
-
-    if "busybox" in args.target:
-        run_ndk_build("B_BB=1")
-
 
 def find_jdk():
     env = os.environ.copy()
@@ -462,6 +576,7 @@ def build_apk(args, module):
             gradlew,
             f"{module}:assemble{build_type}",
             f"-PconfigPath={args.config.resolve()}",
+            f"--max-workers={args.jobs}",
         ],
         env=env,
     )
@@ -507,17 +622,22 @@ def cleanup(args):
 
     if "cpp" in args.target:
         header("* Cleaning C++")
-        rm_rf(Path("native", "libs"))
-        rm_rf(Path("native", "obj"))
-        rm_rf(Path("native", "out"))
+        # Removing these large trees is IO bound, delete them concurrently
+        dirs = [Path("native", "libs"), Path("native", "obj"), Path("native", "out")]
+        with ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+            list(executor.map(rm_rf, dirs))
 
     if "rust" in args.target:
         header("* Cleaning Rust")
         rm_rf(Path("native", "src", "target"))
         rm(Path("native", "src", "boot", "proto", "mod.rs"))
         rm(Path("native", "src", "boot", "proto", "update_metadata.rs"))
-        for rs_gen in glob.glob("native/**/*-rs.*pp", recursive=True):
-            rm(rs_gen)
+        # Skip build output folders, generated sources never live in them
+        for root, dirs, files in os.walk("native"):
+            dirs[:] = [d for d in dirs if d not in ("target", "obj", "libs", "out")]
+            for f in files:
+                if f.endswith(("-rs.cpp", "-rs.hpp")):
+                    rm(Path(root, f))
 
     if "java" in args.target:
         header("* Cleaning java")
@@ -535,8 +655,33 @@ def setup_ndk(args):
     header(f"* Downloading and extracting {ndk_archive}")
     rm_rf(ondk_path)
     with urllib.request.urlopen(url) as response:
-        with tarfile.open(mode="r|xz", fileobj=response) as tar:
-            tar.extractall(ndk_root)
+        xz_bin = shutil.which("xz")
+        tar_bin = shutil.which("tar")
+        if is_windows or xz_bin is None or tar_bin is None:
+            with tarfile.open(
+                mode="r|xz", fileobj=response, bufsize=1024 * 1024
+            ) as tar:
+                tar.extractall(ndk_root)
+        else:
+            # Decompress with the multi-threaded xz decoder
+            ndk_root.mkdir(mode=0o755, parents=True, exist_ok=True)
+            xz_proc = subprocess.Popen(
+                [xz_bin, "-d", "-T", "0"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            tar_proc = subprocess.Popen(
+                [tar_bin, "-xf", "-", "-C", ndk_root], stdin=xz_proc.stdout
+            )
+            xz_proc.stdout.close()
+            try:
+                shutil.copyfileobj(response, xz_proc.stdin, 1024 * 1024)
+            except BrokenPipeError:
+                pass
+            finally:
+                xz_proc.stdin.close()
+            if xz_proc.wait() != 0 or tar_proc.wait() != 0:
+                error(f"Failed to extract {ndk_archive}")
 
     rm_rf(ndk_path)
     mv(ondk_path, ndk_path)
@@ -548,23 +693,29 @@ def push_files(args, script):
         config["outdir"], ("app-release.apk" if args.release else "app-debug.apk")
     )
 
-    # Extract busybox from APK
-    busybox = Path(config["outdir"], "busybox")
-    with ZipFile(apk) as zf:
-        with zf.open(f"lib/{abi}/libbusybox.so") as libbb:
-            with open(busybox, "wb") as bb:
-                bb.write(libbb.read())
-
-    try:
-        proc = execv([adb_path, "push", busybox, script, "/data/local/tmp"])
+    # Stage all files so they can be pushed with a single adb call
+    with tempfile.TemporaryDirectory(dir=config["outdir"]) as stage:
+        stage = Path(stage)
+
+        # Extract busybox from APK
+        busybox = stage / "busybox"
+        with ZipFile(apk) as zf:
+            with zf.open(f"lib/{abi}/libbusybox.so") as libbb:
+                with open(busybox, "wb") as bb:
+                    shutil.copyfileobj(libbb, bb, 1024 * 1024)
+
+        # Keep the APK mtime so --sync can skip it when unchanged
+        magisk_apk = stage / "magisk.apk"
+        try:
+            os.link(apk, magisk_apk)
+        except OSError:
+            shutil.copy2(apk, magisk_apk)
+
+        proc = execv(
+            [adb_path, "push", "--sync", busybox, script, magisk_apk, "/data/local/tmp"]
+        )
         if proc.returncode != 0:
             error("adb push failed!")
-    finally:
-        rm_rf(busybox)
-
-    proc = execv([adb_path, "push", apk, "/data/local/tmp/magisk.apk"])
-    if proc.returncode != 0:
-        error("adb push failed!")
 
 
 def setup_avd(args):
@@ -635,9 +786,9 @@ def setup_rustup(args):
     else:
         cargo_home = Path.home() / ".cargo"
     cargo_bin = cargo_home / "bin"
-    for src in cargo_bin.iterdir():
-        tgt = wrapper_dir / src.name
-        tgt.symlink_to(src)
+    with os.scandir(cargo_bin) as it:
+        for src in it:
+            os.symlink(src.path, os.path.join(wrapper_dir, src.name))
 
     # Build rustup_wrapper
     wrapper_src = Path("tools", "rustup_wrapper")
@@ -657,6 +808,13 @@ parser.add_argument(
     "-r", "--release", action="store_true", help="compile in release mode"
 )
 parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=cpu_count,
+    help=f"number of parallel build jobs (default: {cpu_count})",
+)
 parser.add_argument(
     "-c",
     "--config",
@@ -43,7 +43,7 @@ static void dump_preload() {
     if (fd < 0)
         return;
     fd_stream ch(fd);
-    if (!unxz(ch, byte_view(init_ld_xz, sizeof(init_ld_xz))))
+    if (!unxz(ch, byte_view(init_ld_xz, init_ld_xz_size)))
         return;
     close(fd);
 }